@@ -7,12 +7,16 @@ Class:
                                 brain area.
 """
 import nibabel as nib
+import numpy as np
 import os
-import glob
+import threading
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
 from . import utils
 
 STRUCTURE_SEGMENTATION_PATH = "structure_segmentation" + os.path.sep
 MODES = ["tumor_agnostic", "bias_corrected", "tumor_entity_weighted"]
+INTERIM_FILE_SUFFIXES = ("Tumor.nii.gz", "Tumor.nii", "mixeltype.nii.gz", "_pveseg.nii.gz", "_seg.nii.gz")
 
 
 class StructureSegmentation:
@@ -25,16 +29,27 @@ class StructureSegmentation:
     *Attributes*:
         work_dir:                   Directory of workspace, can be set as argument or actual workspace is set
         input_files_dir:            List of the input images. It is recommended to only use one image.
-        affine:                     Variable for the image affine, every segmentation is mapped
+        affine:                     Image affine of the first input file, every segmentation is mapped
         bool_remove_interim_files:       Bool to remove the created interim files
         mode:                       Selected mode of segmentation
         brain_handling_classes:     List of brain compartment classes, it should be segmented to
         tumor_class_mapping:        Dict of tumor classes with a respective mapping according to brats segmentation
+        nproc:                      Maximum number of parallel threads
+        interim_compress:           Bool to gzip the interim files, uncompressed files are written faster
+        use_internal_gmm:           Bool to segment with an in-process Gaussian mixture instead of fast of FSL
+        tumor_bias_correction:      Bool to estimate the bias field also in the tumor class segmentation
+        volume_cache_budget:        Maximum number of bytes of decoded input volumes that are held during a run
+        out_dir:                    Output directory of the structure segmentation in the workspace
+        modality_basenames:         List of tuples of the input files and their names without extension
 
     Methods
         set_input_structure_seg:        Sets the list of input files
         list_modes:                     prints all implemented modes
+        get_affine:                     Returns the affine of an image, memoized per path
         set_affine:                     STATIC, sets affine and shape of first measure of included state.
+        get_interim_extension:          Returns the file extension of the interim files
+        get_segmentation_function:      Returns the segmentation function according to use_internal_gmm
+        load_volume:                    Loads an input volume, each file is decoded at most once per routine
         split_tumor_from_brain:         Splits the tumor area from the brain area and saves the images
         segment_brain_part:             Segments only the healthy brain part
         tumor_agnostic:                 Segmentation by ignoring the distorted tumor area
@@ -52,11 +67,19 @@ class StructureSegmentation:
         self.work_dir = work_dir
         self.input_files_dir = None
         self.tumor_seg_dir = None
-        self.affine = None
         self.bool_remove_interim_files = True
         self.mode = "bias_corrected"
         self.brain_handling_classes = ["cerebrospinal_fluid", "gray_matter", "white_matter"]
         self.tumor_class_mapping = {"edema": 2, "active": 4, "necrotic": 1}
+        self.nproc = os.cpu_count() or 1
+        self.interim_compress = False
+        self.use_internal_gmm = False
+        self.tumor_bias_correction = True
+        self.volume_cache_budget = 2 * 1024 ** 3
+        self._affine = None
+        self._affine_cache = {}
+        self._volume_cache = {}
+        self._volume_cache_lock = threading.Lock()
 
     def set_input_structure_seg(self, input_files_dir: list, tumor_seg_dir: str = None) -> None:
         """
@@ -68,6 +91,42 @@ class StructureSegmentation:
         """
         self.input_files_dir = input_files_dir
         self.tumor_seg_dir = tumor_seg_dir
+        self._affine = None
+
+    @property
+    def out_dir(self) -> str:
+        """
+        Output directory of the structure segmentation, which follows the current work_dir.
+
+        :return: String of the output directory
+        """
+        return utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
+
+    @property
+    def affine(self) -> np.ndarray:
+        """
+        Affine of the current first input file, which is read once per path with get_affine. Can be overwritten with
+        set_affine until set_input_structure_seg is called again.
+
+        :return: 4x4 affine
+        """
+        if self._affine is not None:
+            return self._affine
+        return self.get_affine(self.input_files_dir[0])
+
+    @affine.setter
+    def affine(self, affine: np.ndarray) -> None:
+        self._affine = affine
+
+    @property
+    def modality_basenames(self) -> list[tuple[str, str]]:
+        """
+        Pairs of the current input files and their file names without extension. The file names are memoized in
+        utils.get_path_file_extension, so repeated access stays cheap.
+
+        :return: List of (input file, file name without extension)
+        """
+        return [(modality, utils.get_path_file_extension(modality)[2]) for modality in self.input_files_dir]
 
     @staticmethod
     def list_modes() -> None:
@@ -78,6 +137,18 @@ class StructureSegmentation:
         """
         print(MODES)
 
+    def get_affine(self, image_dir: str) -> np.ndarray:
+        """
+        Returns the affine of an image. The header of each path is read only once and the affine is memoized.
+
+        :param image_dir: Path of chosen input image
+
+        :return: 4x4 affine
+        """
+        if image_dir not in self._affine_cache:
+            self._affine_cache[image_dir] = nib.load(image_dir).affine
+        return self._affine_cache[image_dir]
+
     def set_affine(self, image_dir: str = None) -> None:
         """
         Sets affine and shape of first measure of included state. The optional argument takes a nibabel Nifti1Image
@@ -89,49 +160,97 @@ class StructureSegmentation:
         """
         if image_dir is None:
             image_dir = self.input_files_dir[0]
-        self.affine = nib.load(image_dir).affine
+        self.affine = self.get_affine(image_dir)
+
+    def get_interim_extension(self) -> str:
+        """
+        Returns the file extension of the interim files. By default, the interim files are written uncompressed, since
+        they are removed after the run and gzip encoding would dominate their writing time.
+
+        :return: String of the file extension
+        """
+        return ".nii.gz" if self.interim_compress else ".nii"
+
+    def get_segmentation_function(self) -> Callable[..., None]:
+        """
+        Returns the segmentation function. By default fast of FSL is used, with use_internal_gmm an in-process Gaussian
+        mixture writes partial volume files of the same naming.
+
+        :return: utils.single_segmentation or utils.single_segmentation_gmm
+        """
+        return utils.single_segmentation_gmm if self.use_internal_gmm else utils.single_segmentation
 
-    def split_tumor_from_brain(self) -> None:
+    def load_volume(self, image_dir: str) -> nib.Nifti1Image:
         """
-        Splits the tumor from the brain area and saves them with 'withTumor' and 'woTumor' endings.
+        Loads an input volume as in-memory Nifti1Image, so that each file is decoded at most once per routine. The
+        decoded volumes are cached by their absolute path, the least recently used ones are dropped if the
+        volume_cache_budget is exceeded and volumes larger than the budget are not cached at all. The cached data must
+        not be modified.
+
+        :param image_dir: Path of the image
+
+        :return: Nifti1Image with decoded data
+        """
+        key = os.path.abspath(image_dir)
+        with self._volume_cache_lock:
+            if key in self._volume_cache:
+                self._volume_cache[key] = self._volume_cache.pop(key)
+                return self._volume_cache[key]
+        image = nib.load(image_dir, mmap=True)
+        image = nib.Nifti1Image(utils.image2data(image), image.affine, image.header)
+        nbytes = image.dataobj.nbytes
+        with self._volume_cache_lock:
+            if nbytes <= self.volume_cache_budget:
+                while sum(cached.dataobj.nbytes for cached in self._volume_cache.values()) + nbytes > \
+                        self.volume_cache_budget:
+                    self._volume_cache.pop(next(iter(self._volume_cache)))
+                self._volume_cache[key] = image
+        return image
+
+    def split_tumor_from_brain(self, cache_volumes: bool = False) -> None:
+        """
+        Splits the tumor from the brain area and saves them with 'withTumor' and 'woTumor' endings. The modalities are
+        split in parallel threads, since NumPy and nibabel release the GIL for the heavy work. The files are written
+        in background threads, so that writing overlaps with the splitting of the remaining modalities.
+
+        :param cache_volumes: Bool to keep the decoded input volumes with load_volume for a later re-read
 
         :return:
         """
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
+        out_dir = utils.mkdir_if_not_exist(self.out_dir)
         seg_id = list(self.tumor_class_mapping.values())
         tumor_mask = utils.image2mask(self.tumor_seg_dir, seg_id[0], seg_id[1:])
-        self.set_affine()
-        image_tumor_mask = nib.Nifti1Image(tumor_mask, self.affine)
-        for modality in self.input_files_dir:
-            _, _, file = utils.get_path_file_extension(modality)
-            for b in [True, False]:
-                if b:
-                    image = utils.cut_area_from_image(modality, image_tumor_mask, True)
-                    nib.save(image, out_dir + file + "-woTumor.nii.gz")
-                else:
-                    image = utils.cut_area_from_image(modality, image_tumor_mask, False)
-                    nib.save(image, out_dir + file + "-withTumor.nii.gz")
+
+        def split_modality(modality: str) -> tuple[nib.Nifti1Image, nib.Nifti1Image]:
+            return utils.split_area_from_image(self.load_volume(modality) if cache_volumes else modality, tumor_mask)
+
+        splits = {}
+        saves = []
+        with ThreadPoolExecutor(max_workers=min(len(self.input_files_dir), self.nproc)) as executor, \
+                ThreadPoolExecutor(max_workers=2) as io_pool:
+            for modality, file in self.modality_basenames:
+                splits[out_dir + file] = executor.submit(split_modality, modality)
+            for file_path, split in splits.items():
+                with_tumor, wo_tumor = split.result()
+                saves.append(io_pool.submit(nib.save, wo_tumor, file_path + "-woTumor" + self.get_interim_extension()))
+                saves.append(io_pool.submit(nib.save, with_tumor,
+                                            file_path + "-withTumor" + self.get_interim_extension()))
+            for save in saves:
+                save.result()
 
     def segment_brain_part(self) -> None:
         """
         Segments the undistorted brain part. Therefore, function 'split_tumor_from_brain' need to be run before or
-        files with the ending '-woTumor.nii.gz' need to be preserved. Segments according to the brain_handling_classes
+        files with the ending '-woTumor' need to be preserved. Segments according to the brain_handling_classes
         and renames the files according to them.
 
         :return: None
         """
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
-        brain_files = []
-        for modality in self.input_files_dir:
-            _, _, file = utils.get_path_file_extension(modality)
-            brain_files.append(out_dir + file + "-woTumor.nii.gz")
-
-        utils.single_segmentation(out_dir + "wms_Brain", brain_files,
-                                  len(self.brain_handling_classes))
-        for i, seg_class in enumerate(self.brain_handling_classes):
-            os.rename(out_dir + "wms_Brain_pve_" + str(i) + ".nii.gz", out_dir + seg_class + ".nii.gz")
+        out_dir = utils.mkdir_if_not_exist(self.out_dir)
+        brain_files = [out_dir + file + "-woTumor" + self.get_interim_extension()
+                       for _, file in self.modality_basenames]
+        self.get_segmentation_function()(out_dir + "wms_Brain", brain_files, len(self.brain_handling_classes))
+        utils.rename_partial_volumes(out_dir + "wms_Brain", out_dir, self.brain_handling_classes)
 
     def tumor_agnostic(self) -> None:
         """
@@ -139,77 +258,94 @@ class StructureSegmentation:
 
         :return: None
         """
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
-        utils.single_segmentation(out_dir, self.input_files_dir, len(self.brain_handling_classes))
-        for i, seg_class in enumerate(self.brain_handling_classes):
-            os.rename(out_dir + "_pve_" + str(i) + ".nii.gz", out_dir + seg_class + ".nii.gz")
+        out_dir = utils.mkdir_if_not_exist(self.out_dir)
+        self.get_segmentation_function()(out_dir, self.input_files_dir, len(self.brain_handling_classes))
+        utils.rename_partial_volumes(out_dir, out_dir, self.brain_handling_classes)
 
     def bias_corrected(self) -> None:
         """
         Sub-routine for the bias corrected approach, where fast is run again on the cut area of the tumor segmentation.
+        Both segmentations write disjoint files and are run concurrently if nproc allows two parallel threads, otherwise
+        one after the other. With tumor_bias_correction set to False, the tumor area is classified without bias field
+        estimation, which is faster but changes the results.
 
         :return: None
         """
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
+        out_dir = utils.mkdir_if_not_exist(self.out_dir)
         self.split_tumor_from_brain()
-        self.segment_brain_part()
 
-        tumor_files = []
         # just returns classification based on intensity
-        for modality in self.input_files_dir:
-            _, _, file = utils.get_path_file_extension(modality)
-            tumor_files.append(out_dir + os.sep + file + "-withTumor.nii.gz")
-        utils.single_segmentation(out_dir + os.sep + "tumor_class", tumor_files,
-                                  len(list(self.tumor_class_mapping.keys())))
-        for i, seg_class in enumerate(list(self.tumor_class_mapping.keys())):
-            os.rename(out_dir + "tumor_class_pve_" + str(i) + ".nii.gz", out_dir + seg_class + ".nii.gz")
+        tumor_files = [out_dir + file + "-withTumor" + self.get_interim_extension()
+                       for _, file in self.modality_basenames]
+        tumor_segmentation_args = (out_dir + "tumor_class", tumor_files, len(list(self.tumor_class_mapping.keys())))
+        if self.nproc < 2:
+            self.get_segmentation_function()(*tumor_segmentation_args, bias_correction=self.tumor_bias_correction)
+            self.segment_brain_part()
+        else:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                tumor_segmentation = executor.submit(self.get_segmentation_function(), *tumor_segmentation_args,
+                                                     bias_correction=self.tumor_bias_correction)
+                self.segment_brain_part()
+                tumor_segmentation.result()
+        utils.rename_partial_volumes(out_dir + "tumor_class", out_dir, list(self.tumor_class_mapping.keys()))
 
     def tumor_entity_weighted(self) -> None:
         """
         Sub-routine for the tumor entity weighted approach, where the actual tumor segmentation is used to create masks
         for cuts of the original image. The original intensities are normalised, which gives three entities with
-        non-binary distribution from 1 to 2 with an offset that allows also 0.
+        non-binary distribution from 1 to 2 with an offset that allows also 0. The outputs are written uncompressed and
+        gzipped once at the end. The input volumes are decoded once for the split and the normalisation, the cache is
+        cleared when the routine is left.
 
         :return: None
         """
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
-        self.split_tumor_from_brain()
-        self.segment_brain_part()
-        tumor_masks = {}
-        for key, value in self.tumor_class_mapping.items():
-            tumor_mask = utils.image2mask(self.tumor_seg_dir, value)
-            tumor_masks[key] = nib.Nifti1Image(tumor_mask, self.affine)
-        # get segmentation and separate in three classes, cut class-wise from mri and normalise
-        for modality in self.input_files_dir:
-            _, _, file = utils.get_path_file_extension(modality)
-            for key in tumor_masks:
-                image = utils.cut_area_from_image(modality, tumor_masks[key], False)
-                array = image.get_fdata()
-                array[array == 0] = -1
-                array = (array - array[array > 0].min()) / (array.max() - array[array > 0].min())
-                array[array < 0] = -1
-                array = array + 1
-                image = nib.Nifti1Image(array, self.affine)
-                nib.save(image, out_dir + os.sep + str(key) + ".nii.gz")
+        try:
+            out_dir = utils.mkdir_if_not_exist(self.out_dir)
+            self.split_tumor_from_brain(cache_volumes=True)
+            self.segment_brain_part()
+            tumor_labels = utils.image2labels(self.tumor_seg_dir)
+            tumor_masks = {}
+            tumor_boxes = {}
+            for key, value in self.tumor_class_mapping.items():
+                tumor_masks[key] = (tumor_labels == value).view(np.uint8)
+                tumor_boxes[key] = utils.mask_bounding_box(tumor_masks[key])
+            # all outputs share affine and dtype, hence one prepared header is reused for each of them
+            header = nib.Nifti1Header()
+            header.set_data_dtype(np.float32)
+
+            def normalise_class(data: np.ndarray, mask: np.ndarray, box: tuple[slice, ...], file_path: str) -> None:
+                array = np.zeros(data.shape, dtype=np.float32)
+                array[box] = utils.normalise_cut_area(data[box] * mask[box])
+                nib.save(nib.Nifti1Image(array, self.affine, header), file_path)
+
+            # get segmentation and separate in three classes, cut class-wise from mri and normalise within the bounding
+            # box of each class. The classes are handled in parallel threads, since they write disjoint files, whereas
+            # all modalities write to the same files.
+            with ThreadPoolExecutor(max_workers=min(len(tumor_masks), self.nproc)) as executor:
+                for modality, _ in self.modality_basenames:
+                    data = utils.image2data(self.load_volume(modality), np.float32)
+                    classes = [executor.submit(normalise_class, data, tumor_masks[key], tumor_boxes[key],
+                                               out_dir + str(key) + ".nii") for key in tumor_masks]
+                    for normalised_class in classes:
+                        normalised_class.result()
+            utils.gzip_files([out_dir + str(key) + ".nii" for key in tumor_masks], self.nproc)
+        finally:
+            self._volume_cache.clear()
 
     def remove_interim_files(self, out_dir: str) -> None:
         """
-        Removes all interim files in a chosen path.
+        Removes all interim files in a chosen path. The directory is scanned once and the file names are matched
+        against the INTERIM_FILE_SUFFIXES.
 
         :param out_dir: chosen path
 
         :return: None
         """
-        files_to_remove = glob.glob(os.path.join(out_dir, '*Tumor.nii.gz'))
-        files_to_remove.extend(glob.glob(os.path.join(out_dir, '*mixeltype.nii.gz')))
-        files_to_remove.extend(glob.glob(os.path.join(out_dir, '*_pveseg.nii.gz')))
-        files_to_remove.extend(glob.glob(os.path.join(out_dir, '*_seg.nii.gz')))
+        with os.scandir(out_dir) as entries:
+            files_to_remove = [entry.path for entry in entries if entry.name.endswith(INTERIM_FILE_SUFFIXES)]
         for file_path in files_to_remove:
             try:
-                os.remove(file_path)
+                os.unlink(file_path)
                 print(f"Removed: {file_path}")
             except Exception as e:
                 print(f"Error removing {file_path}: {e}")
@@ -227,8 +363,7 @@ class StructureSegmentation:
         if (self.mode is MODES[1] or self.mode is MODES[2]) and self.tumor_seg_dir is None:
             raise ValueError(f"Error: For selected mode '{self.mode}' the tumor_seg_dir should not be None.")
 
-        out_dir = utils.set_out_dir(self.work_dir, STRUCTURE_SEGMENTATION_PATH)
-        utils.mkdir_if_not_exist(out_dir)
+        out_dir = utils.mkdir_if_not_exist(self.out_dir)
 
         if self.mode == "tumor_agnostic":
             self.tumor_agnostic()
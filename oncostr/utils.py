@@ -3,23 +3,35 @@ Definition of auxiliary utils functions.
 
 Functions:
     mkdir_if_not_exist:         Creates a directory if that not exists
+    gzip_files:                 Compresses files with gzip in parallel and removes the uncompressed files.
     set_out_dir:                Checks if parent path has separator at end and merges the paths.
     split_path:                 Splits Filepath into file and path.
     get_path_file_extension:    Returns path, the filename and the filename without extension.
+    mask_bounding_box:          Gives the bounding box of the non-zero area of a mask.
     cut_area_from_image:        Cuts an area of that image.
+    split_area_from_image:      Splits an image into the area inside and outside of a mask.
+    image2data:                 Gives the voxel data of a loaded image without promotion to float64.
     image2array:                Takes a directory of an image and gives a numpy array.
-    image2mask:                 Gives deep copy of original image with selected compartments.
+    image2labels:               Gives the integer label array of a segmentation image.
+    image2mask:                 Gives binary mask of original image with selected compartments.
+    normalise_cut_area:         Normalises the intensities of a cut area in-place to the range from 1 to 2.
     single_segmentation:        runs fast segmentation algorithm in default with variable input files.
+    rename_partial_volumes:     Renames the partial volume files of a segmentation to their class names.
+    single_segmentation_gmm:    runs in-process Gaussian mixture segmentation with variable input files.
 """
 
-import fsl.wrappers.fslmaths
 import fsl.wrappers.fast
 import numpy as np
-import copy
-from pathlib import Path
+from pathlib import PurePath
+from functools import lru_cache
 from typing import Union, Any
 import nibabel as nib
 import os
+import gzip
+import shutil
+import subprocess
+
+MAX_LOOKUP_LABEL = 65535
 
 
 def mkdir_if_not_exist(directory: str) -> str:
@@ -35,6 +47,27 @@ def mkdir_if_not_exist(directory: str) -> str:
     return directory
 
 
+def gzip_files(files: list[str], n_threads: int = 1) -> list[str]:
+    """
+    Compresses files with gzip and removes the uncompressed files. If pigz is available, the files are compressed in
+    parallel with n_threads, otherwise python's gzip is used. In both cases the fastest compression level is chosen.
+
+    :param files: List of file paths
+    :param n_threads: Number of threads for pigz
+
+    :return: List of the compressed file paths
+    """
+    pigz = shutil.which("pigz")
+    if pigz is not None:
+        subprocess.run([pigz, "-f", "-1", "-p", str(n_threads)] + files, check=True)
+    else:
+        for file in files:
+            with open(file, "rb") as f_in, gzip.open(file + ".gz", "wb", compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(file)
+    return [file + ".gz" for file in files]
+
+
 def set_out_dir(parent: str, child: str) -> str:
     """
     Checks if parent path has separator at end and merges the paths.
@@ -49,6 +82,7 @@ def set_out_dir(parent: str, child: str) -> str:
     return parent + child
 
 
+@lru_cache(maxsize=256)
 def split_path(s: str) -> tuple[str, str]:
     """
     Splits Filepath into file and path
@@ -57,12 +91,11 @@ def split_path(s: str) -> tuple[str, str]:
 
     :return: (file, path)
     """
-    import os
-    f = os.path.basename(s)
-    p = s[:-(len(f)) - 1]
-    return str(f), str(p)
+    p, f = os.path.split(s)
+    return f, p
 
 
+@lru_cache(maxsize=256)
 def get_path_file_extension(input_file: str) -> tuple[str, str, str]:
     """
     Returns path, the filename and the filename without extension.
@@ -72,41 +105,109 @@ def get_path_file_extension(input_file: str) -> tuple[str, str, str]:
     :return: (path, filename, file without extension)
     """
     file, path = split_path(input_file)
-    file_wo_extension = Path(Path(input_file).stem).stem
+    file_wo_extension = PurePath(PurePath(file).stem).stem
     return path, file, file_wo_extension
 
 
+def mask_bounding_box(mask: np.ndarray) -> tuple[slice, ...]:
+    """
+    Gives the bounding box of the non-zero area of a mask. An empty mask gives empty slices.
+
+    :param mask: Numpy array of the mask
+
+    :return: tuple of slices for each axis
+    """
+    nonzero = np.argwhere(mask)
+    if nonzero.size == 0:
+        return tuple(slice(0, 0) for _ in mask.shape)
+    return tuple(slice(lower, upper + 1) for lower, upper in zip(nonzero.min(axis=0), nonzero.max(axis=0)))
+
+
 def cut_area_from_image(input_image: str, area_mask: nib.Nifti1Image,
-                        inverse: bool = False) -> Union[None, nib.Nifti1Image]:
+                        inverse: bool = False) -> nib.Nifti1Image:
     """
-    Cuts an area of that image.
+    Cuts an area of that image. The mask is multiplied in-process with the voxel data, no fslmaths call is needed.
 
     :param input_image: String of path to Nifti image
     :param area_mask: Mask array
     :param inverse: Bool, true for inverse cut
 
-    :return: optionally returns the image or writes it next to the input image
+    :return: Nifti1Image of the cut area with header of the input image
     """
+    image = nib.load(input_image, mmap=True)
+    mask = image2data(area_mask, np.uint8)
     if inverse:
-        area_mask = fsl.wrappers.fslmaths(area_mask).mul(-1).add(1).run()
+        mask = mask ^ 1
+    return nib.Nifti1Image(image2data(image) * mask, image.affine, image.header)
+
 
-    return fsl.wrappers.fslmaths(input_image).mul(area_mask).run()
+def split_area_from_image(input_image: Union[str, nib.Nifti1Image],
+                          area_mask: np.ndarray) -> tuple[nib.Nifti1Image, nib.Nifti1Image]:
+    """
+    Splits an image into the area inside and outside of the mask. The image is read only once and the outer part is
+    derived from the inner part by a subtraction. Both images keep the header and thus the stored dtype of the input.
 
+    :param input_image: String of path to Nifti image or an already loaded Nifti1Image
+    :param area_mask: Numpy array of the binary mask
 
-def image2array(image_dir: str) -> tuple[Any, Any, Any]:
+    :return: (image with area, image without area)
     """
-    Takes a directory of an image and gives a numpy array.
+    image = nib.load(input_image, mmap=True) if isinstance(input_image, str) else input_image
+    data = image2data(image)
+    with_area = data * area_mask.astype(data.dtype, copy=False)
+    wo_area = data - with_area
+    return nib.Nifti1Image(with_area, image.affine, image.header), nib.Nifti1Image(wo_area, image.affine, image.header)
+
+
+def image2data(image: nib.Nifti1Image, dtype: np.dtype = None) -> np.ndarray:
+    """
+    Gives the voxel data of a loaded image without promotion to float64. If no dtype is given, unscaled data keeps its
+    stored dtype and data with a scaling slope or intercept is given as float32. A given dtype is directly passed to the
+    data proxy, which scales the data into it without an intermediate array.
+
+    :param image: Nifti1Image
+    :param dtype: Optional dtype of the returned array
+
+    :return: numpy array of image data
+    """
+    if dtype is None and (getattr(image.dataobj, "slope", 1.0) != 1.0 or getattr(image.dataobj, "inter", 0.0) != 0.0):
+        dtype = np.float32
+    return np.asarray(image.dataobj, dtype=dtype)
+
+
+def image2array(image_dir: str, dtype: np.dtype = None) -> tuple[Any, Any, Any]:
+    """
+    Takes a directory of an image and gives a numpy array. The data is read via the data proxy in its stored dtype or
+    the given dtype, see image2data, and is not copied, callers that modify the array in-place should take a copy.
 
     :param image_dir: String of a Nifti image directory
+    :param dtype: Optional dtype of the returned array
     :return: numpy array of image data, shape, affine
     """
-    orig_image = nib.load(image_dir)
-    return copy.deepcopy(orig_image.get_fdata()), orig_image.shape, orig_image.affine
+    orig_image = nib.load(image_dir, mmap=True)
+    return image2data(orig_image, dtype), orig_image.shape, orig_image.affine
+
+
+def image2labels(image_dir: str) -> np.ndarray:
+    """
+    Gives the integer label array of a segmentation image. Integer data keeps its stored dtype, other data is rounded
+    to int32, so no label wraps around.
+
+    :param image_dir: String to Nifti image
+
+    :return labels: Numpy integer array of the labels
+    """
+    labels = image2data(nib.load(image_dir, mmap=True))
+    if labels.dtype.kind in "iu":
+        return labels
+    return np.rint(labels).astype(np.int32)
 
 
 def image2mask(image_dir: str, compartment: int, inner_compartments: list[int] = None) -> np.ndarray:
     """
-    Gives deep copy of original image with selected compartments.
+    Gives binary mask of original image with selected compartments. Small non-negative labels are mapped in a single
+    gather through a lookup table, which holds 1 for the selected compartments and 0 otherwise. Negative or large
+    labels are selected with np.isin instead.
 
     :param image_dir: String to Nifti image
     :param compartment: Int, identifier of compartment that shall be filtered
@@ -114,28 +215,149 @@ def image2mask(image_dir: str, compartment: int, inner_compartments: list[int] =
 
     :return mask: Numpy array of the binary mask
     """
-    mask, _, _ = image2array(image_dir)
-    unique = list(np.unique(mask))
-    unique.remove(compartment)
-    mask[np.isclose(mask, compartment)] = 1.0
-    if inner_compartments is not None:
-        for comp in inner_compartments:
-            mask[np.isclose(mask, comp)] = 1.0
-            unique.remove(comp)
-    for outer in unique:
-        mask[np.isclose(mask, outer)] = 0.0
-        unique.remove(outer)
-    return mask
+    labels = image2labels(image_dir)
+    wanted = [compartment] + list(inner_compartments or [])
+    lo = min(int(labels.min()), *wanted)
+    hi = max(int(labels.max()), *wanted)
+    if lo < 0 or hi > MAX_LOOKUP_LABEL:
+        return np.isin(labels, wanted).view(np.uint8)
+    lut = np.zeros(hi + 1, dtype=np.uint8)
+    lut[wanted] = 1
+    return lut[labels]
+
+
+def _normalise_cut_area_kernel(flat: np.ndarray) -> None:
+    """
+    Fused kernel of normalise_cut_area on a flat view, which is compiled with numba by _normalise_cut_area_numba.
+    First, the bounds of the positive voxels are reduced, where 0 marks an empty bound. Second, all voxels are mapped
+    in one pass. The compiled kernel is serial and releases the GIL, so it is safe and runs concurrently in the threads
+    of tumor_entity_weighted regardless of numba's threading layer.
+
+    :param flat: Flat numpy float array of the cut area, modified in-place
 
+    :return: None
+    """
+    lower = 0.0
+    upper = 0.0
+    for i in range(flat.size):
+        if flat[i] > 0:
+            if lower == 0 or flat[i] < lower:
+                lower = flat[i]
+            if flat[i] > upper:
+                upper = flat[i]
+    if upper == 0:
+        flat[:] = 0.0
+        return
+    scale = 1.0 / (upper - lower) if upper > lower else 0.0
+    for i in range(flat.size):
+        flat[i] = (flat[i] - lower) * scale + 1.0 if flat[i] > 0 else 0.0
+
+
+@lru_cache(maxsize=None)
+def _normalise_cut_area_numba() -> Any:
+    """
+    Imports numba and compiles the fused kernel on the first call, so importing the module does not pay for numba.
 
-def single_segmentation(basename: str, files_list: list[str], n_classes: int) -> None:
+    :return: compiled kernel or None if numba is not installed
     """
-    runs fast segmentation algorithm in default with variable input files.
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(nogil=True, fastmath=True, cache=True)(_normalise_cut_area_kernel)
+
+
+def normalise_cut_area(array: np.ndarray) -> np.ndarray:
+    """
+    Normalises the positive intensities of a cut area in-place to the range from 1 to 2, while all other voxels are set
+    to 0. The arithmetic is done in-place on the given float array, so only the gathered positive voxels are allocated,
+    and the outer voxels are zeroed by a masked copy instead of a scatter write. An area without positive voxels, e.g.
+    a tumor class that is not present, gives an array of zeros. If all positive voxels share one intensity, e.g. a
+    single voxel class, they are mapped to 1. If numba is installed, a fused kernel is used for contiguous arrays.
+
+    :param array: Numpy float array of the cut area
+
+    :return: the normalised array
+    """
+    kernel = _normalise_cut_area_numba() if array.flags.c_contiguous else None
+    if kernel is not None:
+        kernel(array.reshape(-1))
+        return array
+    inside = array > 0
+    positives = array[inside]
+    if positives.size == 0:
+        array.fill(0.0)
+        return array
+    lower = positives.min()
+    upper = positives.max()
+    np.subtract(array, lower, out=array)
+    array *= 1.0 / (upper - lower) if upper > lower else 0.0
+    array += 1.0
+    np.copyto(array, 0.0, where=~inside)
+    return array
+
+
+def single_segmentation(basename: str, files_list: list[str], n_classes: int, bias_correction: bool = True) -> None:
+    """
+    runs fast segmentation algorithm in default with variable input files. The bias field estimation can be switched
+    off, which skips the heaviest step of fast.
 
     :param basename: String for base name of outputfiles
     :param files_list: List of input images
     :param n_classes: Number of segmentation classes
+    :param bias_correction: Bool, false runs fast with '--nobias'
+
+    :return: None
+    """
+    fsl.wrappers.fast(files_list, basename, n_classes, nobias=not bias_correction)
+
+
+def single_segmentation_gmm(basename: str, files_list: list[str], n_classes: int, bias_correction: bool = True,
+                            random_state: int = 0) -> None:
+    """
+    runs in-process Gaussian mixture segmentation with variable input files. The voxels that are non-zero in all input
+    images are clustered and the class probabilities are saved like the partial volume files of fast
+    ('<basename>_pve_<i>.nii.gz'), ordered by the mean intensity of the first input image. The k-means initialisation
+    is seeded, so the same input gives the same output.
+
+    :param basename: String for base name of outputfiles
+    :param files_list: List of input images
+    :param n_classes: Number of segmentation classes
+    :param bias_correction: Unused, for a common signature with single_segmentation, no bias field is estimated
+    :param random_state: Int, seed of the k-means initialisation
+
+    :return: None
+    """
+    try:
+        from sklearn.mixture import GaussianMixture
+    except ImportError:
+        raise ImportError("Error: The Gaussian mixture segmentation needs scikit-learn to be installed.")
+    images = [nib.load(file, mmap=True) for file in files_list]
+    data = np.stack([image2data(image, np.float32) for image in images], axis=-1)
+    features = data.reshape(-1, len(images))
+    inside = np.all(features != 0, axis=1)
+    gmm = GaussianMixture(n_classes, covariance_type="full", max_iter=30, init_params="kmeans",
+                          random_state=random_state)
+    probabilities = gmm.fit(features[inside]).predict_proba(features[inside])
+    for i, component in enumerate(np.argsort(gmm.means_[:, 0])):
+        pve = np.zeros(features.shape[0], dtype=np.float32)
+        pve[inside] = probabilities[:, component]
+        pve_image = nib.Nifti1Image(pve.reshape(data.shape[:-1]), images[0].affine)
+        nib.save(pve_image, basename + "_pve_" + str(i) + ".nii.gz")
+
+
+def rename_partial_volumes(basename: str, out_dir: str, classes: list[str]) -> None:
+    """
+    Renames the partial volume files of a segmentation ('<basename>_pve_<i>.nii.gz') to their class names. Existing
+    files with the class names are replaced, so a mode can be run again in the same directory.
+
+    :param basename: String for base name of the segmentation files
+    :param out_dir: String of the output directory
+    :param classes: List of class names in order of the partial volume files
 
     :return: None
     """
-    fsl.wrappers.fast(files_list, basename, n_classes)
+    pairs = [(basename + "_pve_" + str(i) + ".nii.gz", out_dir + seg_class + ".nii.gz")
+             for i, seg_class in enumerate(classes)]
+    for source, destination in pairs:
+        os.replace(source, destination)
@@ -10,6 +10,12 @@ setup(
         "numpy",
     ],
     extras_require={
+        "gmm": [
+            "scikit-learn"
+        ],
+        "numba": [
+            "numba"
+        ],
         "dev": [
             "pytest",
             "black",
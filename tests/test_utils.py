@@ -0,0 +1,42 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from oncostr import utils
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    data = np.arange(1, 28, dtype=np.int16).reshape(3, 3, 3)
+    file = str(tmp_path / "image.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), file)
+    return file, data
+
+
+def mask_image(mask):
+    return nib.Nifti1Image(mask.astype(np.uint8), np.eye(4))
+
+
+def test_cut_area_from_image_empty_mask(image_file):
+    file, data = image_file
+    cut = utils.cut_area_from_image(file, mask_image(np.zeros(data.shape)))
+    assert cut.shape == data.shape
+    assert not np.asarray(cut.dataobj).any()
+
+
+def test_cut_area_from_image_inverse_empty_mask(image_file):
+    file, data = image_file
+    cut = utils.cut_area_from_image(file, mask_image(np.zeros(data.shape)), inverse=True)
+    np.testing.assert_array_equal(np.asarray(cut.dataobj), data)
+
+
+def test_cut_area_from_image_inverse(image_file):
+    file, data = image_file
+    mask = np.zeros(data.shape)
+    mask[1, 1:, :2] = 1
+    area_mask = mask_image(mask)
+    cut = utils.cut_area_from_image(file, area_mask)
+    inverse_cut = utils.cut_area_from_image(file, area_mask, inverse=True)
+    np.testing.assert_array_equal(np.asarray(cut.dataobj), data * mask)
+    np.testing.assert_array_equal(np.asarray(inverse_cut.dataobj), data * (1 - mask))
+    np.testing.assert_array_equal(np.asarray(area_mask.dataobj), mask)